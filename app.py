@@ -1,15 +1,26 @@
-from flask import Flask, render_template, request, Response, stream_with_context, jsonify
+from flask import Flask, render_template, request, Response, stream_with_context, jsonify, make_response
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import uuid
 import time
 import logging
+import httpx
 import openai
+from opentelemetry import context as otel_context
 from opentelemetry import trace
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from opentelemetry.exporter.otlp.proto.http import Compression
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
 
-client = openai.OpenAI()
+# Bound how long a stalled completion can hold a worker; reads are timed per chunk
+client = openai.OpenAI(timeout=httpx.Timeout(60.0, connect=5.0), max_retries=1)
 
 app = Flask(__name__)
 
@@ -18,88 +29,283 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Set up OpenTelemetry tracing
-resource = Resource(attributes={SERVICE_NAME: "splunk-shelly-AI-assistant"})
-provider = TracerProvider(resource=resource)
-trace.set_tracer_provider(provider)
 tracer = trace.get_tracer(__name__)
-otlp_exporter = OTLPSpanExporter(endpoint="http://localhost:4317", insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
+_PROPAGATOR = TraceContextTextMapPropagator()
+
+
+_tracer_provider = None
+
+
+def _init_tracing():
+    global _tracer_provider
+    # A second provider would leave an extra exporter thread and connection running
+    if _tracer_provider is not None:
+        return
+    resource = Resource(attributes={SERVICE_NAME: "splunk-shelly-AI-assistant"})
+    provider = TracerProvider(resource=resource)
+    # OTLP/HTTP avoids the gRPC max message size, which silently drops large span batches
+    otlp_exporter = OTLPSpanExporter(endpoint="http://localhost:4318/v1/traces", compression=Compression.Gzip)
+    span_processor = BatchSpanProcessor(
+        otlp_exporter,
+        max_queue_size=4096,
+        schedule_delay_millis=1000,
+        max_export_batch_size=128,
+        export_timeout_millis=10000,
+    )
+    provider.add_span_processor(span_processor)
+    trace.set_tracer_provider(provider)
+    _tracer_provider = provider
+
+
+# Under a pre-forking server the exporter thread must be started in each worker, not in the parent
+if not os.environ.get("DEFER_TRACING_INIT"):
+    _init_tracing()
 
 # Initialize global variables
-chat_history = [
-    {"role": "system", "content": "Hello, I'm Shelly's Assistant; I (actually) run The Splunk T-Shirt Company. AMA"}]
-GPT_model = "gpt-3.5-turbo"
+SYSTEM_MESSAGE = "Hello, I'm Shelly's Assistant; I (actually) run The Splunk T-Shirt Company. AMA"
+SESSION_COOKIE = "sid"
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+SESSIONS_MAX_SIZE = 1024
+RESPONSE_CACHE = {}
+RESPONSE_CACHE_LOCK = threading.Lock()
+RESPONSE_CACHE_MAX_SIZE = 1024
+SSE_FLUSH_TOKENS = 8
+SSE_FLUSH_INTERVAL = 0.05
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+_SSE_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+STREAM_QUEUE_SIZE = 64
+_STREAM_DONE = object()
+DEFAULT_GPT_MODEL = "gpt-3.5-turbo"
 GPT_temperature = 0.8
 GPT_top_p = 0.5
-active_spans = {}
 span_contexts = {}
+SPAN_CONTEXTS_LOCK = threading.Lock()
+SPAN_CONTEXTS_MAX_SIZE = 1024
+
+
+def _sse_frame(text):
+    # A line break inside a data field would end it, so send one data line per line of text
+    lines = _SSE_LINE_BREAK.split(text)
+    return b"\n".join(_SSE_PREFIX + line.encode("utf-8") for line in lines) + _SSE_SUFFIX
+
+
+def _truncate(s, n=2048):
+    return s if len(s) <= n else s[:n] + f"...[+{len(s) - n} chars]"
+
+
+# A session's messages plus a running hash of them, so the cache key never re-encodes old turns
+class ChatHistory:
+    def __init__(self, messages=()):
+        self._messages = []
+        self._hash = hashlib.sha256()
+        for message in messages:
+            self.append(message)
+
+    def append(self, message):
+        self._messages.append(message)
+        # json.dumps never emits a raw newline, so it cleanly separates messages
+        self._hash.update(json.dumps(message, sort_keys=True).encode("utf-8") + b"\n")
+
+    @property
+    def messages(self):
+        return tuple(self._messages)
+
+    def cache_key(self, model):
+        key = self._hash.copy()
+        key.update(model.encode("utf-8"))
+        return key.hexdigest()
+
+    def __getitem__(self, index):
+        return self._messages[index]
+
+
+def _cache_response(key, value):
+    with RESPONSE_CACHE_LOCK:
+        if len(RESPONSE_CACHE) >= RESPONSE_CACHE_MAX_SIZE:
+            # dicts keep insertion order, so this evicts the oldest entry
+            RESPONSE_CACHE.pop(next(iter(RESPONSE_CACHE)))
+        RESPONSE_CACHE[key] = value
+
+
+def _remember_span_context(span_id, carrier):
+    with SPAN_CONTEXTS_LOCK:
+        # Turns that are never rated would otherwise pile up; drop the oldest
+        if len(span_contexts) >= SPAN_CONTEXTS_MAX_SIZE:
+            span_contexts.pop(next(iter(span_contexts)))
+        span_contexts[span_id] = carrier
+
+
+def _new_chat_history():
+    return ChatHistory([{"role": "system", "content": SYSTEM_MESSAGE}])
+
+
+def _get_session(sid):
+    with SESSIONS_LOCK:
+        # Re-insert on every access so the dict stays in least-recently-used order
+        session = SESSIONS.pop(sid, None)
+        if session is None:
+            session = {"chat_history": _new_chat_history(), "model": DEFAULT_GPT_MODEL}
+            if len(SESSIONS) >= SESSIONS_MAX_SIZE:
+                SESSIONS.pop(next(iter(SESSIONS)))
+        SESSIONS[sid] = session
+        return session
+
+
+def _session_id():
+    return request.cookies.get(SESSION_COOKIE)
+
+
+def _missing_session():
+    return jsonify(success=False, error="Session cookie missing; load / first"), 400
 
 
 @app.route("/", methods=["GET"])
 def index():
-    return render_template("index.html", chat_history=chat_history)
+    sid = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+    response = make_response(render_template("index.html", chat_history=_get_session(sid)["chat_history"].messages))
+    response.set_cookie(SESSION_COOKIE, sid, httponly=True, samesite="Lax")
+    return response
 
 
 @app.route("/chat", methods=["POST"])
 def chat():
+    sid = _session_id()
+    if not sid:
+        return _missing_session()
     content = request.json["message"]
-    global GPT_model
-    GPT_model = request.json["model"]
-    chat_history.append({"role": "user", "content": content})
+    session = _get_session(sid)
+    session["model"] = request.json["model"]
+    session["chat_history"].append({"role": "user", "content": content})
     return jsonify(success=True)
 
 
 @app.route("/stream", methods=["GET"])
 def stream():
+    sid = _session_id()
+    if not sid:
+        return _missing_session()
+    session = _get_session(sid)
+    chat_history = session["chat_history"]
+    model = session["model"]
+
     def generate():
-        assistant_response_content = ""
         start_time = time.time()
         with tracer.start_as_current_span("call_gpt_model") as span:
-            span_id = span.context.span_id
+            span_id = trace.format_span_id(span.context.span_id)
             carrier = {}
-            TraceContextTextMapPropagator().inject(carrier)
-            span_contexts[span_id] = carrier
-            active_spans[span_id] = span
+            _PROPAGATOR.inject(carrier)
+            _remember_span_context(span_id, carrier)
             logger.debug("stream(): span_id: %s", span_id)
+            # Tell the client which span to attach its satisfaction score to
+            yield b"event: span_id\n" + _SSE_PREFIX + span_id.encode("ascii") + _SSE_SUFFIX
 
-            result = ""
             tokens_used = 0
             completion_tokens = 0
+            response_id = None
+            response_model = None
             prompt = chat_history[-1]["content"]
-            with client.chat.completions.create(
-                    model=GPT_model,
-                    messages=chat_history,
-                    stream=True,
-                    temperature=GPT_temperature,
-                    top_p=GPT_top_p,
-            ) as stream:
-                for chunk in stream:
-                    if chunk.choices[0].delta and chunk.choices[0].delta.content:
-                        token_text = chunk.choices[0].delta.content
-                        result += token_text
-                        tokens_used += len(token_text.split())
-                        completion_tokens += 1
-                        span.set_attribute("tokens_used_partial", tokens_used)
-                        span.set_attribute("completion_tokens_partial", completion_tokens)
-                        assistant_response_content += chunk.choices[0].delta.content
-                        yield f"data: {chunk.choices[0].delta.content}\n\n"
-                    if chunk.choices[0].finish_reason == "stop":
-                        break
-
-                end_time = time.time()
-                latency = end_time - start_time
-                span.set_attribute("id", chunk.id)
-                span.set_attribute("GPT-model", chunk.model)
-                span.set_attribute("GPT-temperature", GPT_temperature)
-                span.set_attribute("GPT-top_p", GPT_top_p)
-                span.set_attribute("prompt", prompt)
-                span.set_attribute("response", result)
-                span.set_attribute("latency", latency)
-                span.set_attribute("tokens_used", tokens_used)
-                span.set_attribute("completion_tokens", completion_tokens)
-
-            chat_history.append({"role": "assistant", "content": assistant_response_content})
+
+            def stream_tokens():
+                # Read the OpenAI stream on its own thread so a slow client doesn't stall token ingestion
+                token_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+                stop = threading.Event()
+                parent_context = otel_context.get_current()
+
+                def put(item):
+                    while not stop.is_set():
+                        try:
+                            token_queue.put(item, timeout=0.1)
+                            return
+                        except queue.Full:
+                            pass
+
+                def produce():
+                    nonlocal response_id, response_model
+                    context_token = otel_context.attach(parent_context)
+                    try:
+                        with client.chat.completions.create(
+                                model=model,
+                                messages=chat_history.messages,
+                                stream=True,
+                                temperature=GPT_temperature,
+                                top_p=GPT_top_p,
+                        ) as stream:
+                            for chunk in stream:
+                                if stop.is_set():
+                                    break
+                                if response_id is None:
+                                    response_id = chunk.id
+                                    response_model = chunk.model
+                                choice = chunk.choices[0]
+                                delta = choice.delta
+                                token_text = delta.content if delta else None
+                                if token_text:
+                                    put(token_text)
+                                if choice.finish_reason == "stop":
+                                    break
+                    except Exception as exc:
+                        put(exc)
+                    finally:
+                        put(_STREAM_DONE)
+                        otel_context.detach(context_token)
+
+                producer = threading.Thread(target=produce, daemon=True)
+                producer.start()
+                try:
+                    while True:
+                        item = token_queue.get()
+                        if item is _STREAM_DONE:
+                            break
+                        if isinstance(item, Exception):
+                            raise item
+                        tokens.append(item)
+                        yield item
+                finally:
+                    stop.set()
+
+            cache_key = chat_history.cache_key(model)
+            with RESPONSE_CACHE_LOCK:
+                cached = RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                response_id, response_model, tokens = cached
+                token_source = tokens
+            else:
+                tokens = []
+                token_source = stream_tokens()
+            span.set_attribute("cache_hit", cached is not None)
+
+            pending = []
+            last_flush = time.monotonic()
+            for token_text in token_source:
+                tokens_used += token_text.count(" ")
+                completion_tokens += 1
+                pending.append(token_text)
+                if len(pending) >= SSE_FLUSH_TOKENS or time.monotonic() - last_flush > SSE_FLUSH_INTERVAL:
+                    yield _sse_frame("".join(pending))
+                    pending.clear()
+                    last_flush = time.monotonic()
+            if pending:
+                yield _sse_frame("".join(pending))
+
+            if cached is None:
+                _cache_response(cache_key, (response_id, response_model, tuple(tokens)))
+
+            result = "".join(tokens)
+            end_time = time.time()
+            latency = end_time - start_time
+            span.set_attribute("id", response_id)
+            span.set_attribute("GPT-model", response_model)
+            span.set_attribute("GPT-temperature", GPT_temperature)
+            span.set_attribute("GPT-top_p", GPT_top_p)
+            span.set_attribute("prompt", _truncate(prompt))
+            span.set_attribute("response", _truncate(result))
+            span.set_attribute("latency", latency)
+            span.set_attribute("tokens_used", tokens_used)
+            span.set_attribute("completion_tokens", completion_tokens)
+
+            chat_history.append({"role": "assistant", "content": result})
 
     return Response(stream_with_context(generate()), mimetype="text/event-stream")
 
@@ -107,18 +313,17 @@ def stream():
 @app.route("/satisfaction", methods=["POST"])
 def satisfaction():
     data = request.json
-    span_id = list(active_spans.keys())[0]
+    span_id = data.get("span_id")
     logger.debug("satisfaction(): span_id: %s", span_id)
     score = data.get("score")
-    span_context = span_contexts.get(span_id)
+    with SPAN_CONTEXTS_LOCK:
+        span_context = span_contexts.pop(span_id, None)
 
     if span_context:
-        extracted_context = TraceContextTextMapPropagator().extract(span_context)
+        extracted_context = _PROPAGATOR.extract(span_context)
         with tracer.start_as_current_span("satisfaction", context=extracted_context) as span:
             span.set_attribute("user_satisfaction", score)
             span.end()
-            del active_spans[span_id]
-            del span_contexts[span_id]
             return jsonify(success=True)
     else:
         return jsonify(success=False, error="Span not found"), 404
@@ -126,7 +331,8 @@ def satisfaction():
 
 @app.route("/reset", methods=["POST"])
 def reset_chat():
-    global chat_history
-    chat_history = [{"role": "system",
-                     "content": "Hello, I'm Shelly's Assistant; I (actually) run The Splunk T-Shirt Company. AMA"}]
+    sid = _session_id()
+    if not sid:
+        return _missing_session()
+    _get_session(sid)["chat_history"] = _new_chat_history()
     return jsonify(success=True)
@@ -0,0 +1,26 @@
+# Gunicorn configuration for serving the assistant with many concurrent SSE streams.
+# Launch with: gunicorn -c gunicorn_conf.py app:app
+import os
+
+# Patch the standard library before app.py imports openai/httpx so their sockets yield to gevent
+from gevent import monkey
+
+monkey.patch_all()
+
+bind = "0.0.0.0:5000"
+worker_class = "gevent"
+# Sessions, the response cache and span contexts live in process memory, so every
+# request must reach the same process; one gevent worker still serves many streams
+workers = 1
+worker_connections = 1000
+timeout = 120
+
+# Load the app once in the arbiter; tracing is set up per worker in post_fork instead
+preload_app = True
+os.environ["DEFER_TRACING_INIT"] = "1"
+
+
+def post_fork(server, worker):
+    import app
+
+    app._init_tracing()